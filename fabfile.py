@@ -1,5 +1,6 @@
 import os
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
 import pprint
 
 from invoke import task
@@ -10,15 +11,90 @@ import requests
 
 _p = pprint.PrettyPrinter()
 
+SENTRY_API_URL_DEFAULT = "https://sentry.io/api/0"
+SENTRY_API_URL_OVERRIDE = os.getenv("SENTRY_API_URL")
+CODEBUILD_ENDPOINT_URL = os.getenv("CODEBUILD_ENDPOINT_URL")
+
+BUILD_POLL_INITIAL_DELAY = 3
+BUILD_POLL_MAX_DELAY = 30
+BUILD_TIMEOUT = 30 * 60
+BUILD_DEADLINE_EXCEEDED = "DEADLINE_EXCEEDED"
+SENTRY_TIMEOUT = 30
+
+
+def _push(remote, refspecs, dry_run):
+    """
+        push all refspecs to the remote atomically, raise if any of them got rejected
+
+        each remote takes all refs or none, but remotes are pushed independently
+        so one can still be updated while the other rejects the push
+    """
+    for info in remote.push(refspec=refspecs, dry_run=dry_run, atomic=True):
+        if info.flags & info.ERROR:
+            raise GitCommandError(
+                f"git push {remote.name}", 1, stderr=f"{info.local_ref}: {info.summary}"
+            )
+
+
+def _push_all(repo, remote_names, refspecs, dry_run):
+    """push to every remote concurrently"""
+    with ThreadPoolExecutor(max_workers=len(remote_names)) as executor:
+        futures = [
+            executor.submit(_push, repo.remotes[name], refspecs, dry_run)
+            for name in remote_names
+        ]
+        for future in futures:
+            future.result()
+
+
+def _previous_release_tag(repo, release):
+    """newest tag by version order that is reachable from HEAD, excluding this release"""
+    tags = repo.git.tag("--merged", "HEAD", "--sort=-v:refname").splitlines()
+    return next((t for t in tags if t and t != release), None)
+
+
+def _release_commits(repo, previous_tag):
+    """commit hashes in this release, newest first"""
+    rev_range = f"{previous_tag}..HEAD" if previous_tag else "HEAD"
+    return repo.git.rev_list(rev_range).splitlines()
+
+
+def _wait_for_build(codebuild, build_id):
+    """
+        poll the build with capped exponential backoff until it ends or the deadline passes
+
+        on deadline the build is stopped, so it can't push an image without a Sentry release
+    """
+    deadline = monotonic() + BUILD_TIMEOUT
+    delay = BUILD_POLL_INITIAL_DELAY
+    while monotonic() < deadline:
+        sleep(min(delay, max(deadline - monotonic(), 0)))
+        batch = codebuild.batch_get_builds(ids=[build_id])
+        build = next(
+            (i for i in batch["builds"] if i.get("id", None) == build_id), {}
+        )
+        if build.get("endTime", None) is not None:
+            return build.get("buildStatus", None)
+
+        delay = min(delay * 2, BUILD_POLL_MAX_DELAY)
+
+    print(f"Deadline exceeded, stopping build {build_id}")
+    codebuild.stop_build(id=build_id)
+    return BUILD_DEADLINE_EXCEEDED
+
 
 @task
-def release(c, release):
+def release(c, release, dry_run=False):
     """
         tag current head with version passed in param
 
         instruct codebuild to build a new version
 
         when done instruct sentry of the new build release, version tag, included commit hashes
+
+        with --dry-run no tag is created, pushes are only simulated and CodeBuild or
+        Sentry are only called when CODEBUILD_ENDPOINT_URL or SENTRY_API_URL point
+        to a stub, otherwise the requests are just printed
     """
     SENTRY_PROJECT_NAME = "animetorrents-feed"
     SENTRY_RELESE_TAG = f"animetorrents-feed@{release}"
@@ -28,97 +104,94 @@ def release(c, release):
     AWS_REGION = "eu-west-1"
     AWS_BUILD_NAME = "anime-torrents"
     GIT_REPO = "github.com/vadviktor/animetorrent-feed"
+    GIT_REMOTES = ["github", "aws"]
 
     repo = Repo.init(path=os.getcwd())
 
+    refspecs = ["HEAD"]
+    if dry_run:
+        print(f"Dry run: not creating git tag {release}")
+    else:
+        try:
+            print(f"Creating git tag {release}")
+            repo.create_tag(release)
+        except GitCommandError as e:
+            print("Skipping tag creation: {}".format(e.stderr))
+        refspecs.append(f"refs/tags/{release}")
+
+    # git push head and tag, to all remotes at once
     try:
-        print(f"Creating git tag {release}")
-        repo.create_tag(release)
-    except GitCommandError as e:
-        print("Skipping tag creation: {}".format(e.stderr))
-
-    # git push tag
-    try:
-        print("Pushing tag to github")
-        repo.remotes["github"].push()
-        repo.remotes["github"].push(release)
-        print("Pushing tag to aws")
-        repo.remotes["aws"].push()
-        repo.remotes["aws"].push(release)
+        print("Pushing release to {}".format(", ".join(GIT_REMOTES)))
+        _push_all(repo, GIT_REMOTES, refspecs, dry_run)
     except GitCommandError as e:
         print("Can't push release: {}".format(e.stderr))
         exit(1)
 
     # codebuild
-    aws_session = boto3.session.Session()
-    codebuild = aws_session.client(service_name="codebuild", region_name=AWS_REGION)
-    print("Start a new CodeBuild")
-    response = codebuild.start_build(
+    build_params = dict(
         projectName=AWS_BUILD_NAME,
         environmentVariablesOverride=[
             {"name": "RELEASE_TAG", "value": SENTRY_RELESE_TAG, "type": "PLAINTEXT"}
         ],
     )
-    build_id = response["build"]["id"]
-    end_time = None
-    status = None
-    print("Waiting for the build to finish")
-    while end_time is None:
-        sleep(3)
-        batch = codebuild.batch_get_builds(ids=[build_id])
-        end_time, status = next(
-            (
-                (i.get("endTime", None), i.get("buildStatus", None))
-                for i in batch["builds"]
-                if i.get("id", None) == build_id
-            ),
-            None,
+    if dry_run and CODEBUILD_ENDPOINT_URL is None:
+        print("Dry run: would start a new CodeBuild")
+        _p.pprint(build_params)
+    else:
+        aws_session = boto3.session.Session()
+        codebuild = aws_session.client(
+            service_name="codebuild",
+            region_name=AWS_REGION,
+            endpoint_url=CODEBUILD_ENDPOINT_URL,
         )
-
-    if status == "SUCCEEDED":
-        print("Build finished")
-    elif status in ["FAILED", "FAULT", "TIMED_OUT", "STOPPED"]:
-        print(f"Build {status}")
-        exit(1)
+        print("Start a new CodeBuild")
+        response = codebuild.start_build(**build_params)
+        build_id = response["build"]["id"]
+        print("Waiting for the build to finish")
+        status = _wait_for_build(codebuild, build_id)
+
+        if status == "SUCCEEDED":
+            print("Build finished")
+        else:
+            print(f"Build {status}")
+            exit(1)
 
     # sentry
 
     print("Preparing Sentry release")
-    previous_release_tag = repo.tags[-2].name
-    previous_release_sha = next(
-        (i.commit.hexsha for i in repo.tags if i.name == previous_release_tag), None
-    )
-
-    release_commits = []
-    current_sha = repo.head.commit.hexsha
-    release_commits.append(current_sha)
-    while True:
-        parent_sha = repo.commit(current_sha).parents[0].hexsha
-        if parent_sha == previous_release_sha:
-            break
-
-        release_commits.append(parent_sha)
-        current_sha = parent_sha
+    previous_release_tag = _previous_release_tag(repo, release)
+    release_commits = _release_commits(repo, previous_release_tag)
 
     data = {
         "commits": [{"id": c, "repository": GIT_REPO} for c in release_commits],
         "version": SENTRY_RELESE_TAG,
-        "ref": current_sha,
+        "ref": repo.head.commit.hexsha,
         "projects": [SENTRY_PROJECT_NAME],
     }
+    deploy_data = {"environment": "production"}
+
+    if dry_run and SENTRY_API_URL_OVERRIDE is None:
+        print("Dry run: would create Sentry release and deploy")
+        _p.pprint(data)
+        _p.pprint(deploy_data)
+        return
+
+    sentry_api_url = SENTRY_API_URL_OVERRIDE or SENTRY_API_URL_DEFAULT
+    with requests.Session() as sentry:
+        sentry.headers.update({"Authorization": f"Bearer {SENTRY_AUTH_TOKEN}"})
+
+        print("Creating Sentry release")
+        resp = sentry.post(
+            f"{sentry_api_url}/organizations/viktor-vad/releases/",
+            json=data,
+            timeout=SENTRY_TIMEOUT,
+        )
+        print(resp.status_code, resp.reason)
 
-    print("Creating Sentry release")
-    resp = requests.post(
-        "https://sentry.io/api/0/organizations/viktor-vad/releases/",
-        headers={"Authorization": f"Bearer {SENTRY_AUTH_TOKEN}"},
-        json=data,
-    )
-    print(resp.status_code, resp.reason)
-
-    print("Creating Sentry deploy")
-    resp = requests.post(
-        f"https://sentry.io/api/0/organizations/viktor-vad/releases/{SENTRY_RELESE_TAG}/deploys/",
-        headers={"Authorization": f"Bearer {SENTRY_AUTH_TOKEN}"},
-        json={"environment": "production"},
-    )
-    print(resp.status_code, resp.reason)
+        print("Creating Sentry deploy")
+        resp = sentry.post(
+            f"{sentry_api_url}/organizations/viktor-vad/releases/{SENTRY_RELESE_TAG}/deploys/",
+            json=deploy_data,
+            timeout=SENTRY_TIMEOUT,
+        )
+        print(resp.status_code, resp.reason)